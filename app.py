@@ -4,17 +4,22 @@ import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
 import html
-import math
 import os
 import psycopg2
 import re
 import sys
+import threading
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from tally import (RANKED_CHOICE_NOTE, WEIGHTED_NOTE, PollBallots, build_percentage_bar, build_ranked_results,
+                   poll_type_from_topic, toggle_ranking)
 
 
 MAX_NUM_CHOICES = 30
 
+# How many ranked choice and weighted polls to keep the ballots of in memory
+MAX_CACHED_POLLS = 100
+
 DATABASE_URL = os.environ['DATABASE_URL']
 
 # Initializes the app
@@ -24,6 +29,11 @@ app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
 #con = psycopg2.connect(DATABASE_URL, sslmode='require')
 con = psycopg2.connect(DATABASE_URL)
 
+# The listeners all share the one connection (and so one transaction), so responses are handled one at a time. This
+# also keeps the cached ballots, which are most recently used last, in step with the database
+responses_lock = threading.Lock()
+ballot_cache = {}
+
 # Create the necessary tables in the sqlite database
 with con:
     with con.cursor() as cur:
@@ -33,6 +43,7 @@ with con:
             message_ts TEXT NOT NULL,
             anonymous BOOLEAN NOT NULL,
             allow_multiple BOOLEAN NOT NULL,
+            poll_type TEXT NOT NULL DEFAULT 'standard',
             UNIQUE(channel_id, message_ts)
         )''')
         cur.execute('''CREATE TABLE IF NOT EXISTS choices (
@@ -47,9 +58,13 @@ with con:
             id SERIAL PRIMARY KEY,
             user_id TEXT NOT NULL,
             choice_id INTEGER NOT NULL,
+            rank INTEGER,
             UNIQUE(user_id, choice_id),
             FOREIGN KEY (choice_id) REFERENCES choices (id)
         )''')
+        # Add the columns for ranked choice and weighted polls to tables created before they existed
+        cur.execute("ALTER TABLE polls ADD COLUMN IF NOT EXISTS poll_type TEXT NOT NULL DEFAULT 'standard'")
+        cur.execute('ALTER TABLE responses ADD COLUMN IF NOT EXISTS rank INTEGER')
 
 @app.command("/pollcenta")
 @app.shortcut("pollcenta")
@@ -87,6 +102,29 @@ def pollcenta_command(ack, body, client, logger, payload, *args, **kwargs):
                 "default_to_current_conversation": True
             }
         }]
+    poll_type_options = [
+        {
+            "text": {
+                "type": "plain_text",
+                "text": "Standard (one vote per option)"
+            },
+            "value": "standard"
+        },
+        {
+            "text": {
+                "type": "plain_text",
+                "text": "Ranked choice (instant runoff)"
+            },
+            "value": "ranked"
+        },
+        {
+            "text": {
+                "type": "plain_text",
+                "text": "Weighted (points by rank)"
+            },
+            "value": "weighted"
+        }
+    ]
     base_view = {
         "type": "modal",
         "callback_id": "poll_creator",
@@ -139,6 +177,20 @@ def pollcenta_command(ack, body, client, logger, payload, *args, **kwargs):
                     ]
                 }
             },
+            {
+                "type": "input",
+                "block_id": "poll_type",
+                "label": {
+                    "type": "plain_text",
+                    "text": "Poll type"
+                },
+                "element": {
+                    "type": "radio_buttons",
+                    "action_id": "poll_type",
+                    "initial_option": poll_type_options[0],
+                    "options": poll_type_options
+                }
+            },
             {
                 "type": "input",
                 "block_id": "poll",
@@ -242,7 +294,7 @@ def handle_poll_creation(ack, body, client, view):
     values = view['state']['values']
 
     # Get the channel ID we hid in the divider's block ID
-    channel_id = view['blocks'][2]['block_id']
+    channel_id = [block for block in view['blocks'] if block['type'] == 'divider'][0]['block_id']
 
     # If this was initiated with a shortcut, then the channel ID is passed in a different way
     if channel_id == 'none':
@@ -251,10 +303,17 @@ def handle_poll_creation(ack, body, client, view):
     # Get the basic options the user set
     basic_options = list(map(lambda x: x['value'], values['basics']['basic_values']['selected_options']))
 
+    # Get the poll type (ranked choice and weighted polls always take multiple options)
+    poll_type = values['poll_type']['poll_type']['selected_option']['value']
+
     # Get the poll topic
     prompt = values['poll']['poll']['value']
     topic = '*{}*'.format(prompt)
-    if 'multiselect' in basic_options:
+    if poll_type == 'ranked':
+        topic += '\n' + RANKED_CHOICE_NOTE
+    elif poll_type == 'weighted':
+        topic += '\n' + WEIGHTED_NOTE
+    elif 'multiselect' in basic_options:
         topic += '\nYou may vote for multiple options'
     head_block = {
         "type": "section",
@@ -397,12 +456,22 @@ def handle_make_choice(ack, body, respond):
     anonymous = context_block['elements'][0]['text'].endswith(' | :lock: *Responses:* Anonymous')
     allow_multiple = header_block['text']['text'].endswith('*\nYou may vote for multiple options')
 
+    # Check if this is a ranked choice or weighted poll
+    poll_type = poll_type_from_topic(header_block['text']['text'])
+
     # Get the action button that was clicked
     action_id = int(body['actions'][0]['action_id'].split('_')[1])
 
     # Get the user who responded
     user_id = body['user']['id']
 
+    # Get the choices on the poll
+    choice_actions = [(int(action['action_id'].split('_')[1]), action['text']['text'])
+                      for action_block in action_blocks
+                      for action in action_block['elements']
+                      if re.match("choice_\d+", action['action_id'])]
+    action_ids = [choice_action_id for (choice_action_id, content) in choice_actions]
+
     # If the connection to the database has been closed out from under us, try to reconnect
     global con
     if con.closed:
@@ -421,43 +490,52 @@ def handle_make_choice(ack, body, respond):
         #con = psycopg2.connect(DATABASE_URL, sslmode='require')
         con = psycopg2.connect(DATABASE_URL)
 
-    # Handle the database interactions
-    with con:
-        with con.cursor() as cur:
-            # Insert an entry for this poll into the database if it isn't already present
-            cur.execute('''INSERT INTO polls(channel_id, message_ts, anonymous, allow_multiple)
-                           VALUES (%s, %s, %s, %s)
-                           ON CONFLICT DO NOTHING
-                        ''',
-                        (channel_id, message_ts, anonymous, allow_multiple))
-
-            # Get the poll ID
-            cur.execute('SELECT id FROM polls WHERE channel_id = %s AND message_ts = %s', (channel_id, message_ts))
-            poll_id = cur.fetchone()[0]
-
-            # Insert entries for all the choices if they aren't already present
-            for action_block in action_blocks:
-                for action in action_block['elements']:
-                    if re.match("choice_\d+", action['action_id']):
-                        cur.execute('''INSERT INTO choices(poll_id, action_id, content)
-                                       VALUES (%s, %s, %s)
-                                       ON CONFLICT DO NOTHING
-                                    ''',
-                                    (poll_id, int(action['action_id'].split('_')[1]), action['text']['text']))
-
-            # Check if this user has already chosen the selected response
-            cur.execute('''SELECT responses.id
-                           FROM responses
-                           INNER JOIN choices
-                           ON responses.choice_id=choices.id
-                           WHERE responses.user_id = %s
-                           AND choices.poll_id = %s
-                           AND choices.action_id = %s
-                        ''', (user_id, poll_id, action_id))
-            resp = cur.fetchone()
-            if resp is None:
-                # If multiple responses are not allowed, delete any old ones from this user
-                if not allow_multiple:
+    # Handle the database interactions (see responses_lock)
+    with responses_lock:
+        with con:
+            with con.cursor() as cur:
+                # Insert an entry for this poll into the database if it isn't already present
+                cur.execute('''INSERT INTO polls(channel_id, message_ts, anonymous, allow_multiple, poll_type)
+                               VALUES (%s, %s, %s, %s, %s)
+                               ON CONFLICT DO NOTHING
+                            ''',
+                            (channel_id, message_ts, anonymous, allow_multiple, poll_type))
+
+                # Get the poll ID
+                cur.execute('SELECT id FROM polls WHERE channel_id = %s AND message_ts = %s', (channel_id, message_ts))
+                poll_id = cur.fetchone()[0]
+
+                # Insert entries for all the choices if they aren't already present
+                for (choice_action_id, content) in choice_actions:
+                    cur.execute('''INSERT INTO choices(poll_id, action_id, content)
+                                   VALUES (%s, %s, %s)
+                                   ON CONFLICT DO NOTHING
+                                ''',
+                                (poll_id, choice_action_id, content))
+
+                # Check if this user has already chosen the selected response
+                cur.execute('''SELECT responses.id
+                               FROM responses
+                               INNER JOIN choices
+                               ON responses.choice_id=choices.id
+                               WHERE responses.user_id = %s
+                               AND choices.poll_id = %s
+                               AND choices.action_id = %s
+                            ''', (user_id, poll_id, action_id))
+                resp = cur.fetchone()
+                if poll_type != 'standard':
+                    # Get this user's ranking, and rank or unrank the selected choice
+                    cur.execute('''SELECT choices.action_id
+                                   FROM responses
+                                   INNER JOIN choices
+                                   ON responses.choice_id=choices.id
+                                   WHERE choices.poll_id = %s
+                                   AND responses.user_id = %s
+                                   ORDER BY responses.rank
+                                ''', (poll_id, user_id))
+                    user_ranking = toggle_ranking([row[0] for row in cur.fetchall()], action_id)
+
+                    # Replace the user's old ranking with the new one
                     cur.execute('''DELETE FROM responses
                                    WHERE id IN (
                                        SELECT responses.id
@@ -468,26 +546,101 @@ def handle_make_choice(ack, body, respond):
                                        AND responses.user_id = %s
                                    )
                                 ''', (poll_id, user_id))
-                # Insert an entry for this response
-                cur.execute('''INSERT INTO responses(user_id, choice_id)
-                               SELECT %s, choices.id
-                               FROM choices
-                               WHERE poll_id = %s
-                               AND action_id = %s
-                            ''', (user_id, poll_id, action_id))
-            else:
-                # Delete the entry for this response
-                cur.execute('DELETE FROM responses WHERE id = %s', (resp[0],))
-
-            # Get all the choices and the people who have made them
-            cur.execute('''SELECT choices.content, responses.user_id
-                           FROM choices
-                           LEFT JOIN responses
-                           ON choices.id=responses.choice_id
-                           WHERE choices.poll_id = %s
-                           ORDER BY choices.action_id
-                        ''', (poll_id,))
-            choices = cur.fetchall()
+                    for (rank, ranked_action_id) in enumerate(user_ranking):
+                        cur.execute('''INSERT INTO responses(user_id, choice_id, rank)
+                                       SELECT %s, choices.id, %s
+                                       FROM choices
+                                       WHERE poll_id = %s
+                                       AND action_id = %s
+                                    ''', (user_id, rank + 1, poll_id, ranked_action_id))
+
+                    # Only this user's ballot changed, so update the cached ballots if there are any. They have to be
+                    # loaded again if the poll gained an option since they were cached
+                    poll_ballots = ballot_cache.pop(poll_id, None)
+                    if poll_ballots is not None and poll_ballots.action_ids == action_ids:
+                        poll_ballots.set_ranking(user_id, user_ranking)
+                    else:
+                        # Get every ballot in this poll, with the voters numbered from 0 and each ballot in rank order
+                        cur.execute('''SELECT DENSE_RANK() OVER (ORDER BY responses.user_id) - 1, choices.action_id
+                                       FROM responses
+                                       INNER JOIN choices
+                                       ON responses.choice_id=choices.id
+                                       WHERE choices.poll_id = %s
+                                       ORDER BY responses.user_id, responses.rank
+                                    ''', (poll_id,))
+                        ballot_rows = cur.fetchall()
+
+                        # Get the voters, in the same order they were numbered
+                        cur.execute('''SELECT DISTINCT responses.user_id
+                                       FROM responses
+                                       INNER JOIN choices
+                                       ON responses.choice_id=choices.id
+                                       WHERE choices.poll_id = %s
+                                       ORDER BY responses.user_id
+                                    ''', (poll_id,))
+                        poll_ballots = PollBallots(action_ids, [row[0] for row in cur.fetchall()], ballot_rows)
+                elif resp is None:
+                    # If multiple responses are not allowed, delete any old ones from this user
+                    if not allow_multiple:
+                        cur.execute('''DELETE FROM responses
+                                       WHERE id IN (
+                                           SELECT responses.id
+                                           FROM responses
+                                           INNER JOIN choices
+                                           ON responses.choice_id=choices.id
+                                           WHERE choices.poll_id = %s
+                                           AND responses.user_id = %s
+                                       )
+                                    ''', (poll_id, user_id))
+                    # Insert an entry for this response
+                    cur.execute('''INSERT INTO responses(user_id, choice_id)
+                                   SELECT %s, choices.id
+                                   FROM choices
+                                   WHERE poll_id = %s
+                                   AND action_id = %s
+                                ''', (user_id, poll_id, action_id))
+                else:
+                    # Delete the entry for this response
+                    cur.execute('DELETE FROM responses WHERE id = %s', (resp[0],))
+
+                if poll_type == 'standard':
+                    # Get all the choices and the people who have made them
+                    cur.execute('''SELECT choices.content, responses.user_id
+                                   FROM choices
+                                   LEFT JOIN responses
+                                   ON choices.id=responses.choice_id
+                                   WHERE choices.poll_id = %s
+                                   ORDER BY choices.action_id
+                                ''', (poll_id,))
+                    choices = cur.fetchall()
+
+        if poll_type != 'standard':
+            # Only cache the ballots once the transaction has gone through
+            ballot_cache[poll_id] = poll_ballots
+            while len(ballot_cache) > MAX_CACHED_POLLS:
+                del ballot_cache[next(iter(ballot_cache))]
+            results_blocks = build_ranked_results(poll_type, choice_actions, poll_ballots, anonymous)
+
+    if poll_type != 'standard':
+        # Update the message to include the new results
+        respond(
+            replace_original=True,
+            blocks=[header_block, *action_blocks, *results_blocks, context_block]
+        )
+
+        # Let the user know their current ranking, since it isn't shown anywhere for anonymous polls
+        choice_contents = dict(choice_actions)
+        user_ranking = [ranked_action_id for ranked_action_id in user_ranking if ranked_action_id in choice_contents]
+        if user_ranking:
+            ranking_text = 'Your ranking: ' + ', '.join('{}. {}'.format(rank + 1, choice_contents[ranked_action_id]) for (rank, ranked_action_id) in enumerate(user_ranking))
+        else:
+            ranking_text = 'You have not ranked any options'
+        respond(
+            response_type='ephemeral',
+            replace_original=False,
+            text=ranking_text
+        )
+        return
 
     # Get the choice names
     choice_names = dict.fromkeys(choice[0] for choice in choices)
@@ -513,10 +666,6 @@ def handle_make_choice(ack, body, respond):
             # Calculate the (rounded) percentage who chose this answer (as one of their answers in the multi-select case)
             percentage = round(num_respondents / num_total_respondents * 100)
 
-            # Build a nice percentage bar in increments of 5%
-            count_of_20 = math.ceil(percentage / 5)
-            percentage_bar = '`' + ('\u2588' * count_of_20) + (' \u2062' * (20 - count_of_20)) + '`'
-
             respondents_str = ''
             if not anonymous:
                 respondents_str = '\n' + ', '.join('<@{}>'.format(respondent) for respondent in respondents)
@@ -524,7 +673,7 @@ def handle_make_choice(ack, body, respond):
             # Build the actual response
             results_blocks[-1]['fields'].append({
                 "type": "mrkdwn",
-                "text": "{}\n{} | {}% ({}){}".format(choice_name, percentage_bar, percentage, num_respondents, respondents_str)
+                "text": "{}\n{} | {}% ({}){}".format(choice_name, build_percentage_bar(percentage), percentage, num_respondents, respondents_str)
             })
 
     # Update the message to include the new results
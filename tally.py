@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import collections
+import itertools
+import math
+import numpy as np
+
+
+# Ranked choice and weighted polls are marked by a note on the end of the poll topic
+RANKED_CHOICE_NOTE = 'Ranked choice: click the options in order of preference (click again to unrank)'
+WEIGHTED_NOTE = 'Weighted: click the options in order of preference, earlier picks earn more points (click again to unrank)'
+
+# The outcome of an instant runoff: the first preference counts for every round, the choices eliminated (in order),
+# the index of the winning choice (None if every ballot was exhausted), and the choice each ballot counted for at the end
+RunoffResult = collections.namedtuple('RunoffResult', ['rounds', 'eliminated', 'winner', 'top'])
+
+
+def load_ballots(responses, action_ids):
+    # Pack (voter, action_id) response rows into a dense array of ballots. Voters are numbered from 0 and the rows must
+    # be sorted by voter and then by rank, as the poll's ballot query returns them. Row v of the returned array holds
+    # the choice indices (positions in action_ids) that voter v ranked, best first. Every row is padded out to
+    # len(action_ids) + 1 columns with len(action_ids), which acts as an "exhausted" choice that is never eliminated
+    num_choices = len(action_ids)
+    if not responses:
+        return np.full((0, num_choices + 1), num_choices, dtype=np.int16)
+
+    columns = np.fromiter(itertools.chain.from_iterable(responses), dtype=np.int32, count=2 * len(responses))
+    voters, response_actions = columns[0::2], columns[1::2]
+
+    # Map the action IDs onto choice indices, dropping any responses for choices no longer on the poll
+    choice_lookup = np.full(max(max(action_ids), response_actions.max()) + 1, -1, dtype=np.int16)
+    choice_lookup[np.array(action_ids)] = np.arange(num_choices)
+    choices = choice_lookup[response_actions]
+    known = choices >= 0
+    rows, choices = voters[known], choices[known]
+
+    # Each voter's position within their own run of rows is their preference order
+    run_starts = np.flatnonzero(np.diff(rows, prepend=-1))
+    positions = np.arange(len(rows)) - np.repeat(run_starts, np.diff(run_starts, append=len(rows)))
+
+    ballots = np.full((voters[-1] + 1, num_choices + 1), num_choices, dtype=np.int16)
+    ballots[rows, positions] = choices
+    return ballots
+
+
+def instant_runoff(ballots):
+    num_choices = ballots.shape[1] - 1
+    exhausted = num_choices
+
+    # Every ballot starts out counting for its first preference
+    continuing = np.ones(num_choices + 1, dtype=bool)
+    top = ballots[:, 0].copy()
+    counts = np.bincount(top, minlength=num_choices + 1)
+
+    rounds = []
+    eliminated = []
+    winner = None
+    while True:
+        live_counts = counts[:exhausted]
+        rounds.append(live_counts.copy())
+        total = live_counts.sum()
+        if total == 0:
+            break
+
+        # Stop once a choice holds a majority of the ballots still in play (or is the only one left)
+        remaining = np.flatnonzero(continuing[:exhausted])
+        leader = remaining[np.argmax(live_counts[remaining])]
+        if live_counts[leader] * 2 > total or len(remaining) == 1:
+            winner = int(leader)
+            break
+
+        # Eliminate the choice with the fewest votes (ties go against the choice listed later on the poll)
+        remaining_counts = live_counts[remaining]
+        loser = int(remaining[remaining_counts == remaining_counts.min()][-1])
+        continuing[loser] = False
+        eliminated.append(loser)
+
+        # Only the ballots that were counting for the eliminated choice need to move, each to its best continuing
+        # choice (or the exhausted padding). Everyone else's top choice, and so their count, is unchanged
+        moved = np.flatnonzero(top == loser)
+        if len(moved) != 0:
+            moved_ballots = ballots[moved]
+            top[moved] = moved_ballots[np.arange(len(moved)), continuing[moved_ballots].argmax(axis=1)]
+            counts += np.bincount(top[moved], minlength=num_choices + 1)
+        counts[loser] = 0
+
+    return RunoffResult(rounds, eliminated, winner, top)
+
+
+def borda_scores(ballots):
+    # A voter's first choice earns one point per choice on the poll, their second one fewer, and so on
+    num_choices = ballots.shape[1] - 1
+    points = np.broadcast_to(num_choices - np.arange(num_choices + 1), ballots.shape)
+    ranked = ballots < num_choices
+    return np.bincount(ballots[ranked], weights=points[ranked], minlength=num_choices).astype(np.int64)
+
+
+class PollBallots:
+    # The ballots for one poll, laid out as load_ballots lays them out, with row v holding the ballot of user_ids[v].
+    # Each click only rewrites the clicking user's row, rather than reloading every ballot in the poll
+
+    def __init__(self, action_ids, user_ids, responses):
+        self.action_ids = list(action_ids)
+        self.user_ids = list(user_ids)
+        self.user_rows = {user_id: row for (row, user_id) in enumerate(self.user_ids)}
+        self.choice_indices = {action_id: index for (index, action_id) in enumerate(self.action_ids)}
+
+        # Leave room for new voters, so that adding one doesn't copy every ballot
+        ballots = load_ballots(responses, self.action_ids)
+        self.storage = np.full((max(2 * len(self.user_ids), 16), len(self.action_ids) + 1), len(self.action_ids),
+                               dtype=np.int16)
+        self.storage[:len(ballots)] = ballots
+
+    @property
+    def ballots(self):
+        return self.storage[:len(self.user_ids)]
+
+    def set_ranking(self, user_id, ranking):
+        # Replace a user's ballot with their ranking (a list of action IDs, best first)
+        row = self.user_rows.get(user_id)
+        if row is None:
+            row = len(self.user_ids)
+            if row == len(self.storage):
+                self.storage = np.concatenate((self.storage, np.full_like(self.storage, len(self.action_ids))))
+            self.user_ids.append(user_id)
+            self.user_rows[user_id] = row
+
+        # Drop any choices no longer on the poll, as load_ballots does
+        choices = [self.choice_indices[action_id] for action_id in ranking if action_id in self.choice_indices]
+        self.storage[row] = len(self.action_ids)
+        self.storage[row, :len(choices)] = choices
+
+
+def poll_type_from_topic(topic):
+    # Work out the poll type from the note at the end of the poll topic
+    if topic.endswith('*\n' + RANKED_CHOICE_NOTE):
+        return 'ranked'
+    elif topic.endswith('*\n' + WEIGHTED_NOTE):
+        return 'weighted'
+    return 'standard'
+
+
+def toggle_ranking(ranking, action_id):
+    # Clicking a choice ranks it below everything already ranked, and clicking it again unranks it
+    if action_id in ranking:
+        return [ranked_action_id for ranked_action_id in ranking if ranked_action_id != action_id]
+    return ranking + [action_id]
+
+
+def build_percentage_bar(percentage):
+    # Build a nice percentage bar in increments of 5%
+    count_of_20 = math.ceil(percentage / 5)
+    return '`' + ('\u2588' * count_of_20) + (' \u2062' * (20 - count_of_20)) + '`'
+
+
+def build_ranked_results(poll_type, choice_actions, poll_ballots, anonymous):
+    # Build the results blocks for a ranked choice or weighted poll. The choices (as (action_id, content) pairs) must be
+    # in the same order as the poll ballots' action IDs
+    ballots = poll_ballots.ballots
+    num_choices = len(choice_actions)
+    if not (ballots[:, 0] < num_choices).any():
+        return []
+
+    # Work out the percentage and a short description of the tally for each choice
+    tallies = []
+    winner = None
+    if poll_type == 'ranked':
+        result = instant_runoff(ballots)
+        winner = result.winner
+        final_counts = result.rounds[-1]
+        total_votes = final_counts.sum()
+        eliminated_rounds = {choice: round_num for (round_num, choice) in enumerate(result.eliminated)}
+        for index in range(num_choices):
+            if index in eliminated_rounds:
+                round_num = eliminated_rounds[index]
+                tallies.append((0, 'eliminated in round {} with {}'.format(round_num + 1, result.rounds[round_num][index])))
+            else:
+                percentage = round(final_counts[index] / total_votes * 100) if total_votes != 0 else 0
+                tallies.append((percentage, '{}'.format(final_counts[index])))
+    else:
+        scores = borda_scores(ballots)
+        total_score = scores.sum()
+        for index in range(num_choices):
+            percentage = round(scores[index] / total_score * 100) if total_score != 0 else 0
+            tallies.append((percentage, '{} pts'.format(scores[index])))
+
+    # See who ranked each choice, and where, best ranks first
+    rankers = [[] for index in range(num_choices)]
+    if not anonymous:
+        voters, positions = np.nonzero(ballots[:, :num_choices] < num_choices)
+        order = np.lexsort((voters, positions))
+        voters, positions = voters[order], positions[order]
+        for (voter, position, choice) in zip(voters.tolist(), positions.tolist(), ballots[voters, positions].tolist()):
+            rankers[choice].append('<@{}> ({})'.format(poll_ballots.user_ids[voter], position + 1))
+
+    results_blocks = []
+    for index, ((action_id, content), (percentage, tally_str)) in enumerate(zip(choice_actions, tallies)):
+        # A section can only hold 10 items, so we might need multiple sections
+        if index % 10 == 0:
+            results_blocks.append({
+                "type": "section",
+                "fields": []
+            })
+
+        # Call out the instant runoff winner
+        if index == winner:
+            content = ':trophy: ' + content
+
+        respondents_str = ''
+        if not anonymous:
+            respondents_str = '\n' + ', '.join(rankers[index])
+
+        results_blocks[-1]['fields'].append({
+            "type": "mrkdwn",
+            "text": "{}\n{} | {}% ({}){}".format(content, build_percentage_bar(percentage), percentage, tally_str, respondents_str)
+        })
+
+    return results_blocks
+
+
+# Benchmark the tallies on a large synthetic poll
+if __name__ == "__main__":
+    import timeit
+
+    num_voters = 50000
+    num_choices = 30
+    rng = np.random.default_rng(0)
+
+    # Give the choices uneven popularity so the runoff has to go through a realistic number of rounds, and have each
+    # voter rank a random number of them
+    popularity = rng.dirichlet(np.ones(num_choices))
+    keys = rng.random((num_voters, num_choices)) ** (1 / popularity)
+    preferences = np.argsort(-keys, axis=1)
+    lengths = rng.integers(1, num_choices + 1, size=num_voters)
+    responses = [
+        (voter, int(choice) + 1)
+        for voter in range(num_voters)
+        for choice in preferences[voter, :lengths[voter]]
+    ]
+    action_ids = list(range(1, num_choices + 1))
+
+    user_ids = ['U{}'.format(voter) for voter in range(num_voters)]
+    choice_actions = [(action_id, 'Choice {}'.format(action_id)) for action_id in action_ids]
+    print('{} ballots x {} choices ({} responses)'.format(num_voters, num_choices, len(responses)))
+
+    # A click on a poll whose ballots are already cached rewrites one ballot, then tallies and renders the results
+    poll_ballots = PollBallots(action_ids, user_ids, responses)
+    def cached_click():
+        poll_ballots.set_ranking('U0', [3, 1, 4])
+        return build_ranked_results('ranked', choice_actions, poll_ballots, True)
+
+    # On a cache miss (the first click after a restart, or after an option is added) every ballot is loaded again.
+    # This doesn't include fetching the rows from the database, which takes several times longer than the target
+    def uncached_click():
+        return build_ranked_results('ranked', choice_actions, PollBallots(action_ids, user_ids, responses), True)
+
+    result = instant_runoff(poll_ballots.ballots)
+    print('Instant runoff took {} rounds, winner is choice {}'.format(len(result.rounds), result.winner))
+
+    for name, statement in (
+        ('instant_runoff', lambda: instant_runoff(poll_ballots.ballots)),
+        ('borda_scores', lambda: borda_scores(poll_ballots.ballots)),
+        ('cached click', cached_click),
+        ('uncached click', uncached_click),
+    ):
+        best = min(timeit.repeat(statement, number=1, repeat=5))
+        print('{:>15}: {:8.2f} ms'.format(name, best * 1000))
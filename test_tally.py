@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from tally import (RANKED_CHOICE_NOTE, WEIGHTED_NOTE, PollBallots, borda_scores, build_ranked_results, instant_runoff,
+                   load_ballots, poll_type_from_topic, toggle_ranking)
+
+
+def test_first_round_majority():
+    ballots = load_ballots([(0, 1), (0, 2), (1, 1), (2, 2), (3, 1)], [1, 2, 3])
+    result = instant_runoff(ballots)
+    assert result.winner == 0
+    assert result.eliminated == []
+    assert result.rounds[0].tolist() == [3, 1, 0]
+
+
+def test_tie_eliminates_later_choice():
+    # A and C tie for last place, so C (listed later) goes and its ballot moves to A
+    ballots = load_ballots([(0, 1), (1, 2), (2, 2), (3, 3), (3, 1)], [1, 2, 3])
+    result = instant_runoff(ballots)
+    assert result.eliminated[0] == 2
+    assert result.rounds[1].tolist() == [2, 2, 0]
+
+
+def test_all_ballots_exhausted():
+    # Every ballot only ranks options since removed from the poll, so nothing is left to count
+    ballots = load_ballots([(0, 4), (1, 5), (1, 4)], [1, 2])
+    result = instant_runoff(ballots)
+    assert result.winner is None
+    assert result.eliminated == []
+    assert result.rounds[-1].tolist() == [0, 0]
+
+
+def test_rank_gaps():
+    # Voter 0 ranked A, then an option since removed from the poll, then C. C moves up to second place
+    ballots = load_ballots([(0, 1), (0, 9), (0, 3), (1, 2)], [1, 2, 3])
+    assert ballots.tolist() == [[0, 2, 3, 3], [1, 3, 3, 3]]
+
+
+def test_unknown_choices_dropped():
+    ballots = load_ballots([(0, 7), (1, 8), (1, 2), (2, 1)], [1, 2])
+    assert ballots.tolist() == [[2, 2, 2], [1, 2, 2], [0, 2, 2]]
+    result = instant_runoff(ballots)
+    assert result.rounds[0].tolist() == [1, 1]
+    assert result.winner == 0
+    assert result.top.tolist() == [2, 2, 0]
+
+
+def test_empty_poll():
+    ballots = load_ballots([], [1, 2, 3])
+    assert ballots.shape == (0, 4)
+    result = instant_runoff(ballots)
+    assert result.winner is None
+    assert result.eliminated == []
+    assert np.array_equal(result.rounds[0], [0, 0, 0])
+
+
+def test_toggle_ranking():
+    # Clicking ranks a choice last, and clicking it again unranks it and moves the later choices up
+    assert toggle_ranking([], 2) == [2]
+    assert toggle_ranking([2, 1], 3) == [2, 1, 3]
+    assert toggle_ranking([2, 1, 3, 4], 1) == [2, 3, 4]
+
+
+def test_poll_type_from_topic():
+    assert poll_type_from_topic('*Lunch?*\n' + RANKED_CHOICE_NOTE) == 'ranked'
+    assert poll_type_from_topic('*Lunch?*\n' + WEIGHTED_NOTE) == 'weighted'
+    assert poll_type_from_topic('*Lunch?*\nYou may vote for multiple options') == 'standard'
+    assert poll_type_from_topic('*Lunch?*') == 'standard'
+
+
+def test_borda_scores():
+    ballots = load_ballots([(0, 1), (0, 2), (1, 2), (1, 3), (1, 1)], [1, 2, 3])
+    assert borda_scores(ballots).tolist() == [3 + 1, 2 + 3, 2]
+
+
+def test_poll_ballots_set_ranking():
+    poll_ballots = PollBallots([1, 2, 3], ['U1', 'U2'], [(0, 1), (0, 2), (1, 3)])
+
+    # Existing voters are rewritten in place, and new voters are added on the end
+    poll_ballots.set_ranking('U1', [3])
+    poll_ballots.set_ranking('U3', [2, 9, 1])
+    assert poll_ballots.user_ids == ['U1', 'U2', 'U3']
+    assert poll_ballots.ballots.tolist() == [[2, 3, 3, 3], [2, 3, 3, 3], [1, 0, 3, 3]]
+
+    # The ballots match loading them all again
+    assert np.array_equal(poll_ballots.ballots, load_ballots([(0, 3), (1, 3), (2, 2), (2, 1)], [1, 2, 3]))
+
+
+def test_poll_ballots_grow():
+    poll_ballots = PollBallots([1, 2], [], [])
+    for voter in range(40):
+        poll_ballots.set_ranking('U{}'.format(voter), [voter % 2 + 1])
+    assert len(poll_ballots.ballots) == 40
+    assert poll_ballots.ballots[:, 0].tolist() == [0, 1] * 20
+
+
+def test_ranked_results():
+    # A leads the first round, but C goes out and its ballot carries B past A
+    choice_actions = [(1, 'A'), (2, 'B'), (3, 'C')]
+    poll_ballots = PollBallots([1, 2, 3], ['U1', 'U2', 'U3', 'U4', 'U5'],
+                               [(0, 1), (1, 1), (2, 2), (3, 2), (4, 3), (4, 2)])
+    fields = build_ranked_results('ranked', choice_actions, poll_ballots, True)[0]['fields']
+    assert fields[0]['text'].startswith('A\n')
+    assert fields[0]['text'].endswith('| 40% (2)')
+    assert fields[1]['text'].startswith(':trophy: B\n')
+    assert fields[1]['text'].endswith('| 60% (3)')
+    assert fields[2]['text'].endswith('| 0% (eliminated in round 1 with 1)')
+
+
+def test_weighted_results():
+    choice_actions = [(1, 'A'), (2, 'B')]
+    poll_ballots = PollBallots([1, 2], ['U1', 'U2'], [(0, 1), (0, 2), (1, 1)])
+    fields = build_ranked_results('weighted', choice_actions, poll_ballots, False)[0]['fields']
+    assert fields[0]['text'] == 'A\n{} | 80% (4 pts)\n<@U1> (1), <@U2> (1)'.format('`' + '\u2588' * 16 + ' \u2062' * 4 + '`')
+    assert fields[1]['text'].endswith('| 20% (1 pts)\n<@U1> (2)')
+
+
+def test_results_without_votes():
+    # Nobody has ranked a choice that is still on the poll, so there is nothing to show (and nothing to divide by)
+    choice_actions = [(1, 'A'), (2, 'B')]
+    assert build_ranked_results('weighted', choice_actions, PollBallots([1, 2], ['U1'], [(0, 3)]), True) == []
+    assert build_ranked_results('ranked', choice_actions, PollBallots([1, 2], [], []), True) == []
+
+
+def test_results_sections():
+    # A section holds at most 10 fields
+    action_ids = list(range(1, 13))
+    choice_actions = [(action_id, str(action_id)) for action_id in action_ids]
+    poll_ballots = PollBallots(action_ids, ['U1'], [(0, 12)])
+    results_blocks = build_ranked_results('ranked', choice_actions, poll_ballots, True)
+    assert [len(block['fields']) for block in results_blocks] == [10, 2]